@@ -0,0 +1,77 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from . import models, crud, database
+from .config import settings
+from .tenancy import current_tenant
+
+ARCHIVABLE_STATUSES = ("completed", "cancelled", "no-show")
+
+
+def _copy_rows(source, target, where):
+    columns = [column.name for column in target.columns if column.name != "archived_at"]
+    return insert(target).from_select(columns, select(*[source.c[name] for name in columns]).where(where))
+
+
+async def archive_old_appointments(db: AsyncSession, older_than_days: int = None, batch_size: int = None):
+    older_than_days = older_than_days if older_than_days is not None else settings.archive_after_days
+    batch_size = batch_size or settings.archive_batch_size
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+
+    appointments = models.Appointment.__table__
+    revenues = models.Revenue.__table__
+    moved_appointments = 0
+    moved_revenues = 0
+
+    # Каждая пачка переносится отдельной транзакцией, чтобы не держать блокировку SQLite надолго
+    while True:
+        result = await db.execute(
+            select(appointments.c.id)
+            .where(appointments.c.status.in_(ARCHIVABLE_STATUSES), appointments.c.appointment_date < cutoff)
+            .order_by(appointments.c.id)
+            .limit(batch_size)
+        )
+        ids = result.scalars().all()
+        if not ids:
+            break
+
+        await db.execute(_copy_rows(appointments, models.ArchivedAppointment.__table__, appointments.c.id.in_(ids)))
+        revenue_result = await db.execute(
+            _copy_rows(revenues, models.ArchivedRevenue.__table__, revenues.c.appointment_id.in_(ids))
+        )
+        await db.execute(delete(revenues).where(revenues.c.appointment_id.in_(ids)))
+        await db.execute(delete(appointments).where(appointments.c.id.in_(ids)))
+        await db.commit()
+
+        moved_appointments += len(ids)
+        moved_revenues += revenue_result.rowcount
+
+    if moved_appointments:
+        crud.get_client_history_cache().clear()
+
+    return {
+        "cutoff": cutoff,
+        "archived_appointments": moved_appointments,
+        "archived_revenues": moved_revenues
+    }
+
+
+async def run_periodically():
+    while True:
+        await asyncio.sleep(settings.archive_interval_hours * 60 * 60)
+        # Архивируем салоны, чьи базы сейчас открыты; остальные догонят при следующем запуске
+        for tenant in database.open_tenants():
+            token = current_tenant.set(tenant)
+            try:
+                session_factory = await database.get_session_factory(tenant)
+                async with session_factory() as db:
+                    result = await archive_old_appointments(db)
+                print(f"Archived old appointments for {tenant}: {result}")
+            except Exception as e:
+                print(f"Error archiving appointments for {tenant}: {str(e)}")
+            finally:
+                current_tenant.reset(token)
@@ -1,11 +1,16 @@
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
+import hashlib
+import secrets
+import uuid
 from fastapi import HTTPException, status, Depends
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.ext.asyncio import AsyncSession
 from .config import settings
 from .database import get_db
+from .revocation import revocation_list
+from .tenancy import DEFAULT_TENANT, current_tenant
 
 # Используем sha256_crypt вместо bcrypt для совместимости
 pwd_context = CryptContext(schemes=["sha256_crypt"], deprecated="auto")
@@ -24,10 +29,77 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=settings.access_token_expire_minutes)
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "jti": uuid.uuid4().hex, "tenant": current_tenant.get()})
     encoded_jwt = jwt.encode(to_encode, settings.secret_key, algorithm=settings.algorithm)
     return encoded_jwt
 
+def _hash_refresh_token(token: str) -> str:
+    # Токен случайный и длинный, поэтому достаточно быстрого sha256 вместо медленного хэша паролей
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+async def create_refresh_token(db: AsyncSession, user, family_id: str = None):
+    from .models import RefreshToken
+    
+    token = secrets.token_urlsafe(32)
+    db.add(RefreshToken(
+        user_id=user.id,
+        token_hash=_hash_refresh_token(token),
+        family_id=family_id or uuid.uuid4().hex,
+        expires_at=datetime.utcnow() + timedelta(days=settings.refresh_token_expire_days)
+    ))
+    await db.commit()
+    return token
+
+async def rotate_refresh_token(db: AsyncSession, token: str):
+    from sqlalchemy import update
+    from sqlalchemy.future import select
+    from .models import RefreshToken, User
+    
+    invalid_token_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid refresh token",
+    )
+    result = await db.execute(select(RefreshToken).where(RefreshToken.token_hash == _hash_refresh_token(token)))
+    db_token = result.scalar_one_or_none()
+    if db_token is None or db_token.expires_at < datetime.utcnow():
+        raise invalid_token_exception
+    family_id = db_token.family_id
+    
+    result = await db.execute(select(User).where(User.id == db_token.user_id))
+    user = result.scalar_one_or_none()
+    if user is None or not user.is_active:
+        raise invalid_token_exception
+    
+    # Забираем токен одним UPDATE: из одновременных обновлений с ним выигрывает только одно
+    claimed = await db.execute(
+        update(RefreshToken)
+        .where(RefreshToken.id == db_token.id, RefreshToken.revoked_at == None)
+        .values(revoked_at=datetime.utcnow())
+    )
+    if claimed.rowcount != 1:
+        # Повторное использование уже заменённого токена - вероятная кража, отзываем всю цепочку
+        await db.execute(
+            update(RefreshToken)
+            .where(RefreshToken.family_id == family_id, RefreshToken.revoked_at == None)
+            .values(revoked_at=datetime.utcnow())
+        )
+        await db.commit()
+        raise invalid_token_exception
+    
+    new_token = await create_refresh_token(db, user, family_id=family_id)
+    return user, new_token
+
+async def revoke_refresh_token(db: AsyncSession, token: str):
+    from sqlalchemy import update
+    from .models import RefreshToken
+    
+    await db.execute(
+        update(RefreshToken)
+        .where(RefreshToken.token_hash == _hash_refresh_token(token), RefreshToken.revoked_at == None)
+        .values(revoked_at=datetime.utcnow())
+    )
+    await db.commit()
+
 async def authenticate_user(db: AsyncSession, username: str, password: str):
     from sqlalchemy.future import select
     from .models import User
@@ -56,6 +128,11 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession
             raise credentials_exception
     except JWTError:
         raise credentials_exception
+    if revocation_list.is_revoked(payload.get("jti")):
+        raise credentials_exception
+    # Токен одного салона не действует в другом
+    if payload.get("tenant", DEFAULT_TENANT) != current_tenant.get():
+        raise credentials_exception
     
     result = await db.execute(select(User).where(User.username == username))
     user = result.scalar_one_or_none()
@@ -66,4 +143,9 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession
 async def get_current_active_user(current_user = Depends(get_current_user)):
     if not current_user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
+    return current_user
+
+async def get_current_admin_user(current_user = Depends(get_current_active_user)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
     return current_user
\ No newline at end of file
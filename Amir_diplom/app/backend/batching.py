@@ -0,0 +1,78 @@
+import asyncio
+
+
+class BookingBatcher:
+    """Группирует одновременные записи в одну транзакцию (group commit).
+
+    Один фоновый писатель забирает из очереди до max_size заявок или ждёт
+    не дольше max_wait_ms после первой, выполняет add_fn для каждой и делает
+    один commit. Каждый вызывающий получает свою запись или свою ошибку.
+    """
+
+    def __init__(self, session_factory, add_fn, max_size: int = 50, max_wait_ms: int = 10):
+        self.session_factory = session_factory
+        self.add_fn = add_fn
+        self.max_size = max_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = None
+        self._writer = None
+
+    async def submit(self, item):
+        if self._writer is None or self._writer.done():
+            self._queue = asyncio.Queue()
+            self._writer = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def close(self):
+        # Дописывает уже принятые заявки и останавливает писателя
+        if self._writer is not None and not self._writer.done():
+            await self._queue.put(None)
+            await self._writer
+        self._writer = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            entry = await self._queue.get()
+            if entry is None:
+                return
+            batch = [entry]
+            closing = False
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if entry is None:
+                    closing = True
+                    break
+                batch.append(entry)
+            await self._commit(batch)
+            if closing:
+                return
+
+    async def _commit(self, batch):
+        try:
+            async with self.session_factory() as db:
+                rows = [await self.add_fn(db, item) for item, _ in batch]
+                await db.commit()
+        except Exception as e:
+            if len(batch) == 1:
+                _, future = batch[0]
+                if not future.done():
+                    future.set_exception(e)
+                return
+            # Одна ошибочная заявка не должна валить всю пачку: повторяем по одной
+            for entry in batch:
+                await self._commit([entry])
+            return
+
+        for (_, future), row in zip(batch, rows):
+            if not future.done():
+                future.set_result(row)
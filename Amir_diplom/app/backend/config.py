@@ -6,9 +6,33 @@ load_dotenv()
 
 class Settings(BaseSettings):
     database_url: str = "sqlite+aiosqlite:///./app.db"
+    multi_tenant: bool = False
+    tenant_header: str = "X-Tenant"
+    tenants: str = ""  # салоны через запятую; запросы к остальным получают 404, их БД не создаются
+    tenant_base_domain: str = ""  # при "salon.example.com" салон берётся из поддомена
+    tenant_database_url_template: str = "sqlite+aiosqlite:///./tenants/{tenant}.db"
+    tenant_max_engines: int = 32
     secret_key: str = os.getenv("SECRET_KEY", "your-secret-key-here-change-in-production")
     algorithm: str = "HS256"
     access_token_expire_minutes: int = 30
+    refresh_token_expire_days: int = 30
+    revocation_sync_seconds: int = 30
+    idempotency_ttl_seconds: int = 24 * 60 * 60
+    idempotency_max_entries: int = 10000
+    archive_after_days: int = 365
+    archive_batch_size: int = 500
+    archive_interval_hours: int = 0  # 0 - только ручной запуск через /admin/archive
+    booking_batch_enabled: bool = False
+    booking_batch_max_size: int = 50
+    booking_batch_max_wait_ms: int = 10
+    client_history_cache_size: int = 1000
+    client_history_cache_ttl_seconds: int = 30  # ограничивает устаревание при нескольких воркерах
+    jobs_max_workers: int = 2
+    jobs_dir: str = "./job_results"
+    jobs_result_ttl_minutes: int = 60
+    profile_dir: str = "./profiles"
+    profile_max_reports: int = 50
+    profile_top_functions: int = 40
     
     class Config:
         env_file = ".env"
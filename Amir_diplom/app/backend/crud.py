@@ -1,10 +1,38 @@
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy.orm import selectinload
-from sqlalchemy import func, and_
-from . import models, schemas
+from sqlalchemy.orm import selectinload, aliased
+from sqlalchemy import func, and_, or_, update
+from . import models, schemas, database, batching, cache, revocation
+from .tenancy import DEFAULT_TENANT
+from .config import settings
 from datetime import datetime, timedelta
 import calendar
+import re
+import secrets
+
+# Кэш истории записей клиента текущего салона: ключ (нормализованный телефон, include_archived)
+def get_client_history_cache():
+    state = database.get_tenant_state()
+    if "client_history_cache" not in state:
+        state["client_history_cache"] = cache.LRUCache(
+            settings.client_history_cache_size, settings.client_history_cache_ttl_seconds
+        )
+    return state["client_history_cache"]
+
+def normalize_phone(phone: str) -> str:
+    digits = re.sub(r'\D', '', phone or '')
+    # +7 900..., 8 900... и 900... - один и тот же номер
+    if len(digits) == 11 and digits[0] == '8':
+        digits = '7' + digits[1:]
+    elif len(digits) == 10:
+        digits = '7' + digits
+    return digits
+
+def invalidate_client_history(phone: str):
+    phone_key = normalize_phone(phone)
+    client_history_cache = get_client_history_cache()
+    client_history_cache.invalidate((phone_key, False))
+    client_history_cache.invalidate((phone_key, True))
 
 async def create_user(db: AsyncSession, user: schemas.UserCreate):
     from .auth import get_password_hash
@@ -23,23 +51,119 @@ async def get_user_by_username(db: AsyncSession, username: str):
     result = await db.execute(select(models.User).where(models.User.username == username))
     return result.scalar_one_or_none()
 
-async def create_client(db: AsyncSession, client: schemas.ClientCreate):
-    result = await db.execute(select(models.Client).where(models.Client.phone == client.phone))
-    existing_client = result.scalar_one_or_none()
+async def _upsert_client(db: AsyncSession, client: schemas.ClientCreate):
+    phone_key = normalize_phone(client.phone)
+    # Точное совпадение телефона важнее совпадения по нормализованному ключу
+    result = await db.execute(
+        select(models.Client)
+        .where(or_(models.Client.phone == client.phone, models.Client.phone_key == phone_key))
+        .order_by((models.Client.phone == client.phone).desc())
+        .limit(1)
+    )
+    db_client = result.scalars().first()
     
-    if existing_client:
-        for key, value in client.dict().items():
-            if hasattr(existing_client, key) and value is not None:
-                setattr(existing_client, key, value)
-        await db.commit()
-        await db.refresh(existing_client)
-        return existing_client
+    if db_client:
+        for key, value in client.dict(exclude={'phone'}).items():
+            if hasattr(db_client, key) and value is not None:
+                setattr(db_client, key, value)
+        db_client.phone_key = phone_key
     else:
-        db_client = models.Client(**client.dict())
+        db_client = models.Client(**client.dict(), phone_key=phone_key)
         db.add(db_client)
+    await db.flush()
+    return db_client
+
+async def create_client(db: AsyncSession, client: schemas.ClientCreate):
+    db_client = await _upsert_client(db, client)
+    await db.commit()
+    await db.refresh(db_client)
+    invalidate_client_history(db_client.phone)
+    return db_client
+
+DATA_VERSIONS = ("services", "settings")
+
+async def get_data_version(db: AsyncSession, name: str) -> int:
+    result = await db.execute(select(models.DataVersion.version).where(models.DataVersion.name == name))
+    return result.scalar() or 0
+
+# Вызывается до commit, чтобы новая версия и изменение попали в одну транзакцию
+async def bump_data_version(db: AsyncSession, name: str):
+    await db.execute(
+        update(models.DataVersion)
+        .where(models.DataVersion.name == name)
+        .values(version=models.DataVersion.version + 1)
+    )
+
+# Начальные данные и разовые миграции данных для новой или существующей БД салона
+async def prepare_db(db: AsyncSession, tenant: str):
+    from .auth import get_password_hash
+    
+    result = await db.execute(select(models.User).where(models.User.username == "admin"))
+    user = result.scalar_one_or_none()
+    if not user:
+        password = "admin123"
+        if tenant != DEFAULT_TENANT:
+            # Известный пароль по умолчанию оставляем только основной БД
+            password = secrets.token_urlsafe(12)
+            print(f"Created admin user for tenant {tenant} with password: {password}")
+        admin_user = models.User(
+            username="admin",
+            email="admin@salon.com",
+            hashed_password=get_password_hash(password),
+            is_admin=True
+        )
+        db.add(admin_user)
+        await db.commit()
+
+    result = await db.execute(select(models.Service))
+    services = result.scalars().all()
+    if not services:
+        demo_services = [
+            models.Service(
+                name="Стрижка женская",
+                price=1500.0,
+                duration=60,
+                description="Стрижка и укладка"
+            ),
+            models.Service(
+                name="Стрижка мужская", 
+                price=800.0,
+                duration=30,
+                description="Стрижка машинкой или ножницами"
+            ),
+            models.Service(
+                name="Окрашивание",
+                price=2500.0,
+                duration=120,
+                description="Окрашивание волос"
+            ),
+            models.Service(
+                name="Маникюр",
+                price=1000.0,
+                duration=60,
+                description="Классический маникюр"
+            ),
+        ]
+        for service in demo_services:
+            db.add(service)
+        await db.commit()
+
+    for name in DATA_VERSIONS:
+        if await db.get(models.DataVersion, name) is None:
+            db.add(models.DataVersion(name=name, version=0))
+    await db.commit()
+
+    await backfill_client_phone_keys(db)
+    await backfill_appointment_snapshots(db)
+    await revocation.sync(db, tenant)
+
+async def backfill_client_phone_keys(db: AsyncSession):
+    result = await db.execute(select(models.Client).where(models.Client.phone_key == None))
+    clients = result.scalars().all()
+    for client in clients:
+        client.phone_key = normalize_phone(client.phone)
+    if clients:
         await db.commit()
-        await db.refresh(db_client)
-        return db_client
 
 async def get_clients(db: AsyncSession, skip: int = 0, limit: int = 100):
     result = await db.execute(select(models.Client).offset(skip).limit(limit))
@@ -49,9 +173,26 @@ async def get_client(db: AsyncSession, client_id: int):
     result = await db.execute(select(models.Client).where(models.Client.id == client_id))
     return result.scalar_one_or_none()
 
+# Разовое заполнение снимка услуги для записей, созданных до его появления
+async def backfill_appointment_snapshots(db: AsyncSession):
+    for appointment in (models.Appointment, models.ArchivedAppointment):
+        service = select(models.Service).where(models.Service.id == appointment.service_id)
+        await db.execute(
+            update(appointment)
+            .where(appointment.service_name == None)
+            .values(
+                service_name=service.with_only_columns(models.Service.name).scalar_subquery(),
+                service_price=service.with_only_columns(models.Service.price).scalar_subquery(),
+                service_duration=service.with_only_columns(models.Service.duration).scalar_subquery()
+            )
+            .execution_options(synchronize_session=False)
+        )
+    await db.commit()
+
 async def create_service(db: AsyncSession, service: schemas.ServiceCreate):
     db_service = models.Service(**service.dict())
     db.add(db_service)
+    await bump_data_version(db, "services")
     await db.commit()
     await db.refresh(db_service)
     return db_service
@@ -70,32 +211,65 @@ async def update_service(db: AsyncSession, service_id: int, service: schemas.Ser
     if db_service:
         for key, value in service.dict().items():
             setattr(db_service, key, value)
+        await bump_data_version(db, "services")
         await db.commit()
         await db.refresh(db_service)
     return db_service
 
-async def create_appointment(db: AsyncSession, appointment: schemas.AppointmentCreate):
+# Добавляет клиента и запись в текущую транзакцию без commit;
+# after_add(db, запись) может дописать в ту же транзакцию свои строки
+async def _add_appointment(db: AsyncSession, appointment: schemas.AppointmentCreate, after_add=None):
     client_data = schemas.ClientCreate(
         name=appointment.client_name,
         phone=appointment.client_phone
     )
-    client = await create_client(db, client_data)
+    service = await get_service(db, appointment.service_id)
+    if service is None:
+        raise ValueError("Service not found")
+    client = await _upsert_client(db, client_data)
     
     db_appointment = models.Appointment(
         client_id=client.id,
         service_id=appointment.service_id,
         appointment_date=appointment.appointment_date,
-        notes=appointment.notes
+        notes=appointment.notes,
+        service_name=service.name,
+        service_price=service.price,
+        service_duration=service.duration
     )
     db.add(db_appointment)
-    await db.commit()
-    await db.refresh(db_appointment)
-    
-    result = await db.execute(
-        select(models.Appointment)
-        .where(models.Appointment.id == db_appointment.id)
-    )
-    return result.scalar_one()
+    await db.flush()
+    if after_add:
+        after_add(db, db_appointment)
+    return db_appointment
+
+async def _add_queued_appointment(db: AsyncSession, item):
+    appointment, after_add = item
+    return await _add_appointment(db, appointment, after_add)
+
+# У каждого салона свой файл БД, поэтому и свой писатель; он закрывается вместе с движком салона
+async def get_booking_batcher():
+    session_factory = await database.get_session_factory()
+    state = database.get_tenant_state()
+    if "booking_batcher" not in state:
+        state["booking_batcher"] = batching.BookingBatcher(
+            session_factory,
+            _add_queued_appointment,
+            max_size=settings.booking_batch_max_size,
+            max_wait_ms=settings.booking_batch_max_wait_ms
+        )
+    return state["booking_batcher"]
+
+async def create_appointment(db: AsyncSession, appointment: schemas.AppointmentCreate, after_add=None):
+    if settings.booking_batch_enabled:
+        # Запись уходит в общую транзакцию единственного писателя
+        db_appointment = await (await get_booking_batcher()).submit((appointment, after_add))
+    else:
+        db_appointment = await _add_appointment(db, appointment, after_add)
+        await db.commit()
+        await db.refresh(db_appointment)
+    invalidate_client_history(appointment.client_phone)
+    return db_appointment
 
 async def get_appointments(db: AsyncSession, skip: int = 0, limit: int = 100):
     result = await db.execute(
@@ -113,41 +287,84 @@ async def get_appointments_with_details(db: AsyncSession, skip: int = 0, limit:
             models.Appointment,
             models.Client.name.label('client_name'),
             models.Client.phone.label('client_phone'),
-            models.Service.name.label('service_name'),
-            models.Service.price.label('service_price')
+            models.Appointment.service_name,
+            models.Appointment.service_price
         )
         .join(models.Client)
-        .join(models.Service)
         .offset(skip)
         .limit(limit)
         .order_by(models.Appointment.appointment_date.desc())
     )
     return result.all()
 
-async def get_appointments_by_phone(db: AsyncSession, phone: str):
+async def get_appointments_by_phone(db: AsyncSession, phone: str, include_archived: bool = False):
     result = await db.execute(
         select(
             models.Appointment,
             models.Client.name.label('client_name'),
             models.Client.phone.label('client_phone'),
-            models.Service.name.label('service_name'),
-            models.Service.price.label('service_price')
+            models.Appointment.service_name,
+            models.Appointment.service_price
         )
         .join(models.Client)
-        .join(models.Service)
-        .where(models.Client.phone == phone)
+        .where(models.Client.phone_key == normalize_phone(phone))
         .order_by(models.Appointment.appointment_date.desc())
     )
-    return result.all()
+    rows = result.all()
+    if not include_archived:
+        return rows
+
+    # Архивная запись возвращается под именем Appointment, чтобы строки имели одинаковую форму
+    archived = aliased(models.ArchivedAppointment, name='Appointment')
+    archived_result = await db.execute(
+        select(
+            archived,
+            models.Client.name.label('client_name'),
+            models.Client.phone.label('client_phone'),
+            archived.service_name,
+            archived.service_price
+        )
+        .join(models.Client, archived.client_id == models.Client.id)
+        .where(models.Client.phone_key == normalize_phone(phone))
+    )
+    rows.extend(archived_result.all())
+    rows.sort(key=lambda row: row.Appointment.appointment_date, reverse=True)
+    return rows
+
+def appointment_row_to_dict(row):
+    return {
+        "id": row.Appointment.id,
+        "client_id": row.Appointment.client_id,
+        "service_id": row.Appointment.service_id,
+        "appointment_date": row.Appointment.appointment_date,
+        "status": row.Appointment.status,
+        "notes": row.Appointment.notes,
+        "created_at": row.Appointment.created_at,
+        "client_name": row.client_name,
+        "client_phone": row.client_phone,
+        "service_name": row.service_name,
+        "service_price": row.service_price
+    }
+
+async def get_client_history(db: AsyncSession, phone: str, include_archived: bool = False):
+    cache_key = (normalize_phone(phone), include_archived)
+    client_history_cache = get_client_history_cache()
+    history = client_history_cache.get(cache_key)
+    if history is None:
+        generation = client_history_cache.generation
+        rows = await get_appointments_by_phone(db, phone, include_archived=include_archived)
+        history = [appointment_row_to_dict(row) for row in rows]
+        client_history_cache.put(cache_key, history, generation)
+    return history
 
 async def get_all_appointments_with_filters(db: AsyncSession, status: str = None, date_from: str = None, date_to: str = None):
     query = select(
         models.Appointment,
         models.Client.name.label('client_name'),
         models.Client.phone.label('client_phone'),
-        models.Service.name.label('service_name'),
-        models.Service.price.label('service_price')
-    ).join(models.Client).join(models.Service)
+        models.Appointment.service_name,
+        models.Appointment.service_price
+    ).join(models.Client)
     
     if status and status != 'all':
         query = query.where(models.Appointment.status == status)
@@ -165,6 +382,67 @@ async def get_all_appointments_with_filters(db: AsyncSession, status: str = None
     result = await db.execute(query)
     return result.all()
 
+APPOINTMENT_STATUSES = ['pending', 'confirmed', 'completed', 'cancelled', 'no-show']
+
+async def get_calendar(db: AsyncSession, date_from: datetime, date_to: datetime):
+    result = await db.execute(
+        select(
+            models.Appointment.id,
+            models.Appointment.appointment_date,
+            models.Appointment.status,
+            models.Appointment.client_id,
+            models.Appointment.service_id,
+            models.Client.name,
+            models.Client.phone,
+            models.Appointment.service_name,
+            models.Appointment.service_duration
+        )
+        .join(models.Client)
+        .where(models.Appointment.appointment_date >= date_from, models.Appointment.appointment_date < date_to)
+        .order_by(models.Appointment.appointment_date)
+    )
+    
+    # Колоночный формат: параллельные массивы и индексы в таблицы клиентов и услуг без повторов
+    statuses = list(APPOINTMENT_STATUSES)
+    status_codes = {name: code for code, name in enumerate(statuses)}
+    clients = {"id": [], "name": [], "phone": []}
+    services = {"id": [], "name": []}
+    client_index = {}
+    service_index = {}
+    appointments = {"id": [], "start": [], "duration": [], "status": [], "client": [], "service": []}
+    
+    for appointment_id, appointment_date, status, client_id, service_id, client_name, client_phone, service_name, duration in result.all():
+        if status not in status_codes:
+            status_codes[status] = len(statuses)
+            statuses.append(status)
+        if client_id not in client_index:
+            client_index[client_id] = len(clients["id"])
+            clients["id"].append(client_id)
+            clients["name"].append(client_name)
+            clients["phone"].append(client_phone)
+        # Услуга могла быть переименована, поэтому в таблице услуг различаем и снимок названия
+        service_key = (service_id, service_name)
+        if service_key not in service_index:
+            service_index[service_key] = len(services["id"])
+            services["id"].append(service_id)
+            services["name"].append(service_name)
+        
+        appointments["id"].append(appointment_id)
+        appointments["start"].append(int((appointment_date - date_from).total_seconds() // 60))
+        appointments["duration"].append(duration or 0)
+        appointments["status"].append(status_codes[status])
+        appointments["client"].append(client_index[client_id])
+        appointments["service"].append(service_index[service_key])
+    
+    return {
+        "from": date_from,
+        "to": date_to,
+        "statuses": statuses,
+        "clients": clients,
+        "services": services,
+        "appointments": appointments
+    }
+
 async def get_appointment(db: AsyncSession, appointment_id: int):
     result = await db.execute(
         select(models.Appointment)
@@ -182,20 +460,16 @@ async def update_appointment_status(db: AsyncSession, appointment_id: int, statu
     if appointment:
         appointment.status = status
         
-        if status == "completed":
-            service_result = await db.execute(
-                select(models.Service).where(models.Service.id == appointment.service_id)
+        if status == "completed" and appointment.service_price is not None:
+            # Выручка - по цене на момент записи, а не по текущей цене услуги
+            revenue = models.Revenue(
+                service_id=appointment.service_id,
+                appointment_id=appointment.id,
+                service_revenue=appointment.service_price,
+                material_costs=0,
+                net_revenue=appointment.service_price
             )
-            service = service_result.scalar_one_or_none()
-            if service:
-                revenue = models.Revenue(
-                    service_id=appointment.service_id,
-                    appointment_id=appointment.id,
-                    service_revenue=service.price,
-                    material_costs=0,
-                    net_revenue=service.price
-                )
-                db.add(revenue)
+            db.add(revenue)
         
         await db.commit()
         await db.refresh(appointment)
@@ -205,14 +479,16 @@ async def update_appointment_status(db: AsyncSession, appointment_id: int, statu
                 models.Appointment,
                 models.Client.name.label('client_name'),
                 models.Client.phone.label('client_phone'),
-                models.Service.name.label('service_name'),
-                models.Service.price.label('service_price')
+                models.Appointment.service_name,
+                models.Appointment.service_price
             )
             .join(models.Client)
-            .join(models.Service)
             .where(models.Appointment.id == appointment_id)
         )
-        return detailed_result.first()
+        detailed = detailed_result.first()
+        if detailed:
+            invalidate_client_history(detailed.client_phone)
+        return detailed
     return None
 
 async def get_statistics(db: AsyncSession):
@@ -232,25 +508,45 @@ async def get_statistics(db: AsyncSession):
     revenue_result = await db.execute(select(func.sum(models.Revenue.net_revenue)))
     total_revenue = revenue_result.scalar() or 0
     
+    # Итоги за всё время учитывают и архив
+    archived_result = await db.execute(
+        select(
+            func.count(models.ArchivedAppointment.id),
+            func.count(models.ArchivedAppointment.id).filter(models.ArchivedAppointment.status == 'completed')
+        )
+    )
+    archived_total, archived_completed = archived_result.one()
+    total_appointments += archived_total or 0
+    completed_appointments += archived_completed or 0
+    
+    archived_revenue_result = await db.execute(select(func.sum(models.ArchivedRevenue.net_revenue)))
+    total_revenue += archived_revenue_result.scalar() or 0
+    
     now = datetime.utcnow()
     first_day = datetime(now.year, now.month, 1)
-    monthly_revenue_result = await db.execute(
-        select(func.sum(models.Revenue.net_revenue)).where(models.Revenue.date >= first_day)
-    )
-    monthly_revenue = monthly_revenue_result.scalar() or 0
+    # Запись архивируется по дате визита, а выручка датирована завершением,
+    # поэтому выручка этого месяца может уже лежать в архиве
+    monthly_revenue = 0
+    for revenue in (models.Revenue, models.ArchivedRevenue):
+        monthly_revenue_result = await db.execute(
+            select(func.sum(revenue.net_revenue)).where(revenue.date >= first_day)
+        )
+        monthly_revenue += monthly_revenue_result.scalar() or 0
     
-    popular_services_result = await db.execute(
-        select(
-            models.Service.name,
-            func.count(models.Appointment.id).label('count')
+    # Как и итоги выше - за всё время, включая архив; название берём из снимка услуги в записи
+    service_counts = {}
+    for appointment in (models.Appointment, models.ArchivedAppointment):
+        popular_services_result = await db.execute(
+            select(appointment.service_name, func.count(appointment.id))
+            .where(appointment.service_name != None)
+            .group_by(appointment.service_name)
         )
-        .select_from(models.Appointment)
-        .join(models.Service)
-        .group_by(models.Service.name)
-        .order_by(func.count(models.Appointment.id).desc())
-        .limit(5)
-    )
-    popular_services = [{"name": row[0], "count": row[1]} for row in popular_services_result.all()]
+        for name, count in popular_services_result.all():
+            service_counts[name] = service_counts.get(name, 0) + count
+    popular_services = [
+        {"name": name, "count": count}
+        for name, count in sorted(service_counts.items(), key=lambda item: (-item[1], item[0]))[:5]
+    ]
     
     return {
         "total_appointments": total_appointments,
@@ -281,6 +577,7 @@ async def update_admin_settings(db: AsyncSession, settings_data: schemas.AdminSe
         settings = models.AdminSettings(**settings_data.dict())
         db.add(settings)
     
+    await bump_data_version(db, "settings")
     await db.commit()
     await db.refresh(settings)
     return settings
\ No newline at end of file
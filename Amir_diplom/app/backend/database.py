@@ -1,17 +1,150 @@
+import asyncio
+import os
+from collections import OrderedDict
+from sqlalchemy import MetaData, inspect, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateTable
 from .config import settings
 from .models import Base
+from .tenancy import DEFAULT_TENANT, current_tenant, known_tenants, tenant_database_url
 
 engine = create_async_engine(settings.database_url, echo=True)
 AsyncSessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
-async def init_db():
-    async with engine.begin() as conn:
+# Открытые движки салонов (кроме основного), самый давно использованный закрывается первым.
+# Вместе с движком хранится состояние салона (кэши, писатель записей) и закрывается вместе с ним
+_tenant_engines = OrderedDict()
+_tenant_lock = asyncio.Lock()
+_default_state = {}
+
+# create_all не меняет существующие таблицы, поэтому новые колонки и их индексы добавляем сами
+def _add_missing_columns(connection):
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(connection.dialect)
+            connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            for index in table.indexes:
+                if column.name in index.columns:
+                    index.create(connection, checkfirst=True)
+
+# Таблицы, чьи строки уходят в архив с прежним id, и их архивные пары
+ARCHIVED_ID_TABLES = {"appointments": "archived_appointments", "revenues": "archived_revenues"}
+
+# Без AUTOINCREMENT SQLite снова выдаёт id удалённых строк, а после архивации это id из архива.
+# Включить AUTOINCREMENT у существующей таблицы можно только пересозданием
+def _enable_autoincrement(connection):
+    if connection.dialect.name != "sqlite":
+        return
+    for table_name, archive_table_name in ARCHIVED_ID_TABLES.items():
+        table = Base.metadata.tables[table_name]
+        sql = connection.execute(
+            text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": table_name}
+        ).scalar()
+        if "AUTOINCREMENT" not in sql.upper():
+            metadata = MetaData()
+            for other in Base.metadata.sorted_tables:
+                if other is not table:
+                    other.to_metadata(metadata)
+            new_table = table.to_metadata(metadata, name=f"{table_name}_new")
+            columns = ", ".join(column.name for column in table.columns)
+            connection.execute(CreateTable(new_table))
+            connection.execute(text(f"INSERT INTO {new_table.name} ({columns}) SELECT {columns} FROM {table_name}"))
+            connection.execute(text(f"DROP TABLE {table_name}"))
+            connection.execute(text(f"ALTER TABLE {new_table.name} RENAME TO {table_name}"))
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+        
+        # Счётчик не должен быть ниже id, уже ушедших в архив
+        max_id = connection.execute(text(
+            f"SELECT max(id) FROM (SELECT id FROM {table_name} UNION ALL SELECT id FROM {archive_table_name})"
+        )).scalar() or 0
+        seq = connection.execute(
+            text("SELECT seq FROM sqlite_sequence WHERE name = :name"), {"name": table_name}
+        ).scalar()
+        if seq is None:
+            connection.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)"), {"name": table_name, "seq": max_id})
+        elif seq < max_id:
+            connection.execute(text("UPDATE sqlite_sequence SET seq = :seq WHERE name = :name"), {"name": table_name, "seq": max_id})
+
+async def init_db(db_engine=None):
+    async with (db_engine or engine).begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_add_missing_columns)
+        await conn.run_sync(_enable_autoincrement)
+
+def _ensure_sqlite_dir(database_url: str):
+    url = make_url(database_url)
+    if url.get_backend_name() == "sqlite" and url.database:
+        directory = os.path.dirname(url.database)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+async def get_session_factory(tenant: str = None):
+    tenant = tenant or current_tenant.get()
+    if tenant == DEFAULT_TENANT:
+        return AsyncSessionLocal
+    
+    if tenant in _tenant_engines:
+        _tenant_engines.move_to_end(tenant)
+        return _tenant_engines[tenant][1]
+    
+    if tenant not in known_tenants():
+        raise LookupError(f"Unknown tenant: {tenant}")
+    
+    async with _tenant_lock:
+        if tenant in _tenant_engines:
+            return _tenant_engines[tenant][1]
+        from .crud import prepare_db
+        
+        database_url = tenant_database_url(tenant)
+        _ensure_sqlite_dir(database_url)
+        tenant_engine = create_async_engine(database_url, echo=engine.echo)
+        session_factory = sessionmaker(tenant_engine, class_=AsyncSession, expire_on_commit=False)
+        await init_db(tenant_engine)
+        async with session_factory() as db:
+            await prepare_db(db, tenant)
+        
+        _tenant_engines[tenant] = (tenant_engine, session_factory, {})
+        while len(_tenant_engines) > settings.tenant_max_engines:
+            _, (evicted_engine, _, evicted_state) = _tenant_engines.popitem(last=False)
+            await _close_state(evicted_state)
+            await evicted_engine.dispose()
+        return session_factory
+
+def get_tenant_state(tenant: str = None) -> dict:
+    tenant = tenant or current_tenant.get()
+    if tenant == DEFAULT_TENANT:
+        return _default_state
+    entry = _tenant_engines.get(tenant)
+    # Движок уже закрыт - отдаём временный словарь, чтобы состояние не пережило движок
+    return entry[2] if entry else {}
+
+async def _close_state(state: dict):
+    for value in state.values():
+        if hasattr(value, "close"):
+            await value.close()
+    state.clear()
+
+def open_tenants():
+    return [DEFAULT_TENANT, *_tenant_engines]
+
+async def dispose_engines():
+    while _tenant_engines:
+        _, (tenant_engine, _, state) = _tenant_engines.popitem()
+        await _close_state(state)
+        await tenant_engine.dispose()
+    await _close_state(_default_state)
+    await engine.dispose()
 
 async def get_db():
-    async with AsyncSessionLocal() as session:
+    session_factory = await get_session_factory()
+    async with session_factory() as session:
         try:
             yield session
         finally:
@@ -0,0 +1,172 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import delete
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from . import models
+from .config import settings
+from .tenancy import current_tenant
+
+MAX_KEY_LENGTH = 255
+PRUNE_EVERY = 100
+
+
+class IdempotencyStore:
+    """Ограниченное in-memory хранилище ответов с TTL и вытеснением LRU.
+
+    Таблица idempotency_keys дублирует его для нескольких воркеров,
+    а словарь _in_flight схлопывает одновременные повторы в одно выполнение.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: int):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._inserts = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, fingerprint, status_code, body = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return fingerprint, status_code, body
+
+    def put(self, key, fingerprint: str, status_code: int, body):
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, fingerprint, status_code, body)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+store = IdempotencyStore(settings.idempotency_max_entries, settings.idempotency_ttl_seconds)
+
+
+def fingerprint(payload) -> str:
+    data = json.dumps(jsonable_encoder(payload), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def _check_fingerprint(expected: str, actual: str):
+    if expected != actual:
+        raise HTTPException(
+            status_code=422,
+            detail="Idempotency-Key was already used with a different request body"
+        )
+
+
+async def _load(db: AsyncSession, key: str, request_fingerprint: str):
+    result = await db.execute(select(models.IdempotencyKey).where(models.IdempotencyKey.key == key))
+    row = result.scalar_one_or_none()
+    if row is None:
+        return None
+    # Строка без ответа могла остаться от прежней схемы с отдельным резервированием ключа
+    if row.status_code is None or row.created_at < datetime.utcnow() - timedelta(seconds=store.ttl_seconds):
+        await db.delete(row)
+        await db.commit()
+        return None
+    _check_fingerprint(row.fingerprint, request_fingerprint)
+    return row.status_code, json.loads(row.response_body)
+
+
+async def _prune(db: AsyncSession):
+    store._inserts += 1
+    if store._inserts % PRUNE_EVERY == 0:
+        cutoff = datetime.utcnow() - timedelta(seconds=store.ttl_seconds)
+        await db.execute(delete(models.IdempotencyKey).where(models.IdempotencyKey.created_at < cutoff))
+        await db.commit()
+
+
+def _recorder(key: str, request_fingerprint: str):
+    def record(db: AsyncSession, body):
+        db.add(models.IdempotencyKey(
+            key=key,
+            fingerprint=request_fingerprint,
+            status_code=200,
+            response_body=json.dumps(body, ensure_ascii=False)
+        ))
+    return record
+
+
+async def execute(db: AsyncSession, key: str, request_fingerprint: str, handler):
+    """Выполняет handler(record) не более одного раза для данного ключа.
+
+    Возвращает (status_code, body, replayed). handler должен вызвать record(session, body)
+    в той же транзакции, которая создаёт запись, и вернуть JSON-сериализуемое тело ответа:
+    ключ и результат фиксируются одним commit. Ошибки не кэшируются, чтобы клиент мог повторить запрос.
+    """
+    if len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail="Idempotency-Key is too long")
+
+    # В памяти ключи разделены по салонам; в БД салона достаточно самого ключа
+    store_key = (current_tenant.get(), key)
+    cached = store.get(store_key)
+    if cached:
+        stored_fingerprint, status_code, body = cached
+        _check_fingerprint(stored_fingerprint, request_fingerprint)
+        return status_code, body, True
+
+    in_flight = store._in_flight.get(store_key)
+    if in_flight:
+        stored_fingerprint, future = in_flight
+        _check_fingerprint(stored_fingerprint, request_fingerprint)
+        try:
+            status_code, body = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not future.cancelled() or asyncio.current_task().cancelling():
+                raise
+            # Отменили исходный запрос (клиент оборвал соединение), а не этот повтор:
+            # берём сохранённый ответ или выполняем запрос заново
+            return await execute(db, key, request_fingerprint, handler)
+        return status_code, body, True
+
+    future = asyncio.get_running_loop().create_future()
+    store._in_flight[store_key] = (request_fingerprint, future)
+    try:
+        loaded = await _load(db, key, request_fingerprint)
+        if loaded:
+            status_code, body = loaded
+            replayed = True
+        else:
+            await _prune(db)
+            # Снимаем блокировку чтения: при group commit запись делает другая сессия
+            await db.rollback()
+            try:
+                body = await handler(_recorder(key, request_fingerprint))
+                status_code = 200
+                replayed = False
+            except IntegrityError as e:
+                # Тот же ключ успел закоммитить другой воркер - отдаём его ответ
+                await db.rollback()
+                loaded = await _load(db, key, request_fingerprint)
+                if not loaded:
+                    # Конфликт не по ключу, а по данным записи
+                    raise HTTPException(status_code=400, detail=str(e))
+                status_code, body = loaded
+                replayed = True
+        store.put(store_key, request_fingerprint, status_code, body)
+        future.set_result((status_code, body))
+        return status_code, body, replayed
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except BaseException as e:
+        future.set_exception(e)
+        # Исключение уже отдано вызывающему; ожидающие повторы получат его через future
+        future.exception()
+        raise
+    finally:
+        store._in_flight.pop(store_key, None)
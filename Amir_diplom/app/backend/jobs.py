@@ -0,0 +1,236 @@
+import asyncio
+import csv
+import hashlib
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from fastapi import HTTPException
+from sqlalchemy import create_engine, func, select
+
+from . import models
+from .config import settings
+from .tenancy import current_tenant, tenant_database_url
+
+
+# --- Работа в отдельном процессе: своё синхронное подключение к БД ---
+
+def _sync_database_url(database_url: str) -> str:
+    return database_url.replace("+aiosqlite", "")
+
+
+def _date_filters(column, params):
+    filters = []
+    if params.get("date_from"):
+        filters.append(column >= datetime.strptime(params["date_from"], '%Y-%m-%d'))
+    if params.get("date_to"):
+        filters.append(column < datetime.strptime(params["date_to"], '%Y-%m-%d') + timedelta(days=1))
+    return filters
+
+
+def _revenue_report(connection, params, writer):
+    totals = {}
+    # Название услуги - из снимка в записи, чтобы переименование не меняло прошлые отчёты
+    for revenue, appointment in ((models.Revenue, models.Appointment),
+                                 (models.ArchivedRevenue, models.ArchivedAppointment)):
+        month = func.strftime('%Y-%m', revenue.date)
+        service_name = func.coalesce(appointment.service_name, '')
+        rows = connection.execute(
+            select(
+                month,
+                service_name,
+                func.count(revenue.id),
+                func.sum(revenue.service_revenue),
+                func.sum(revenue.material_costs),
+                func.sum(revenue.net_revenue)
+            )
+            .select_from(revenue)
+            .outerjoin(appointment, revenue.appointment_id == appointment.id)
+            .where(*_date_filters(revenue.date, params))
+            .group_by(month, service_name)
+        )
+        for row_month, service_name, count, service_revenue, material_costs, net_revenue in rows:
+            total = totals.setdefault((row_month, service_name), [0, 0.0, 0.0, 0.0])
+            total[0] += count
+            total[1] += service_revenue or 0
+            total[2] += material_costs or 0
+            total[3] += net_revenue or 0
+
+    writer.writerow(["month", "service", "appointments", "service_revenue", "material_costs", "net_revenue"])
+    for (row_month, service_name), total in sorted(totals.items()):
+        writer.writerow([row_month, service_name, *total])
+
+
+def _appointments_export(connection, params, writer):
+    writer.writerow(["id", "appointment_date", "status", "client_name", "client_phone",
+                     "service_name", "service_price", "notes", "archived"])
+    tables = [models.Appointment]
+    if params.get("include_archived", True):
+        tables.append(models.ArchivedAppointment)
+    for appointment in tables:
+        query = (
+            select(
+                appointment.id,
+                appointment.appointment_date,
+                appointment.status,
+                models.Client.name,
+                models.Client.phone,
+                appointment.service_name,
+                appointment.service_price,
+                appointment.notes
+            )
+            .join(models.Client, appointment.client_id == models.Client.id)
+            .where(*_date_filters(appointment.appointment_date, params))
+            .order_by(appointment.appointment_date)
+        )
+        if params.get("status") and params["status"] != 'all':
+            query = query.where(appointment.status == params["status"])
+        archived = appointment is models.ArchivedAppointment
+        for row in connection.execute(query):
+            writer.writerow([*row, archived])
+
+
+REPORTS = {
+    "revenue": _revenue_report,
+    "appointments_export": _appointments_export,
+}
+
+
+def run_report(kind: str, params: dict, database_url: str, path: str):
+    engine = create_engine(_sync_database_url(database_url))
+    tmp_path = path + ".tmp"
+    try:
+        with engine.connect() as connection, open(tmp_path, "w", newline="", encoding="utf-8") as f:
+            REPORTS[kind](connection, params, csv.writer(f))
+        os.replace(tmp_path, path)
+    finally:
+        engine.dispose()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# --- Реестр задач в процессе веб-сервера ---
+
+_executor = None
+_jobs = {}
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=settings.jobs_max_workers)
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _job_key(kind: str, params: dict, database_url: str) -> str:
+    data = json.dumps([kind, params, database_url], sort_keys=True)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:32]
+
+
+def _validate(kind: str, params: dict):
+    if kind not in REPORTS:
+        raise HTTPException(status_code=400, detail=f"Unknown report kind. Available: {', '.join(REPORTS)}")
+    for key in ("date_from", "date_to"):
+        if params.get(key):
+            try:
+                datetime.strptime(params[key], '%Y-%m-%d')
+            except (TypeError, ValueError):
+                raise HTTPException(status_code=400, detail=f"{key} must be in YYYY-MM-DD format")
+
+
+def cleanup_expired():
+    now = time.time()
+    for job_id, job in list(_jobs.items()):
+        if job["expires_at"] and job["expires_at"] < now:
+            if os.path.exists(job["path"]):
+                os.remove(job["path"])
+            del _jobs[job_id]
+    # Файлы, оставшиеся от прошлых запусков сервера
+    if os.path.isdir(settings.jobs_dir):
+        known = {job["path"] for job in _jobs.values()}
+        for name in os.listdir(settings.jobs_dir):
+            path = os.path.join(settings.jobs_dir, name)
+            if path not in known and os.path.getmtime(path) < now - settings.jobs_result_ttl_minutes * 60:
+                os.remove(path)
+
+
+async def _run(job):
+    job["status"] = "running"
+    job["started_at"] = datetime.utcnow()
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            _get_executor(), run_report, job["kind"], job["params"], job["database_url"], job["path"]
+        )
+        job["status"] = "done"
+    except Exception as e:
+        job["status"] = "failed"
+        job["error"] = str(e)
+    job["finished_at"] = datetime.utcnow()
+    job["expires_at"] = time.time() + settings.jobs_result_ttl_minutes * 60
+
+
+def submit(kind: str, params: dict):
+    _validate(kind, params)
+    cleanup_expired()
+    tenant = current_tenant.get()
+    database_url = tenant_database_url(tenant)
+    job_key = _job_key(kind, params, database_url)
+
+    # Одинаковый отчёт, который ещё считается, не запускаем повторно; готовый пересчитываем,
+    # чтобы он учитывал изменения после прошлого запуска
+    for job in _jobs.values():
+        if job["key"] == job_key and job["status"] in ("queued", "running"):
+            return job
+
+    os.makedirs(settings.jobs_dir, exist_ok=True)
+    job_id = uuid.uuid4().hex
+    job = {
+        "id": job_id,
+        "key": job_key,
+        "kind": kind,
+        "params": params,
+        "tenant": tenant,
+        "database_url": database_url,
+        "path": os.path.join(settings.jobs_dir, f"{job_id}.csv"),
+        "status": "queued",
+        "error": None,
+        "created_at": datetime.utcnow(),
+        "started_at": None,
+        "finished_at": None,
+        "expires_at": None,
+    }
+    _jobs[job_id] = job
+    job["task"] = asyncio.create_task(_run(job))
+    return job
+
+
+def get_job(job_id: str):
+    cleanup_expired()
+    job = _jobs.get(job_id)
+    if not job or job["tenant"] != current_tenant.get():
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    return job
+
+
+def job_status(job):
+    return {
+        "id": job["id"],
+        "kind": job["kind"],
+        "params": job["params"],
+        "status": job["status"],
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+        "expires_at": datetime.utcfromtimestamp(job["expires_at"]) if job["expires_at"] else None,
+    }
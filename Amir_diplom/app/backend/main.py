@@ -1,14 +1,19 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Request, Form
+import asyncio
+from fastapi import FastAPI, Depends, HTTPException, status, Request, Form, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, Response
 from fastapi.templating import Jinja2Templates
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from . import crud, schemas, database, models
+from . import crud, schemas, database, models, idempotency, archive, jobs, revocation, tenancy, profiling
 from typing import List, Optional
 from datetime import datetime, timedelta
-from .auth import get_current_user, get_current_active_user, authenticate_user, create_access_token, get_password_hash
+from .auth import get_current_user, get_current_active_user, get_current_admin_user, authenticate_user, create_access_token, get_password_hash
+from .auth import oauth2_scheme, create_refresh_token, rotate_refresh_token, revoke_refresh_token
+from jose import JWTError, jwt
 from .config import settings
 
 app = FastAPI(title="Salon Management System", version="1.0.0")
@@ -25,54 +30,69 @@ app.mount("/static", StaticFiles(directory="frontend"), name="static")
 
 templates = Jinja2Templates(directory="frontend")
 
+CALENDAR_MAX_DAYS = 62
+
+# Ответ с ETag по версии данных: при совпадении service worker получает 304,
+# а сам запрос к услугам или настройкам не выполняется
+async def versioned_response(request: Request, db: AsyncSession, name: str, load, variant: str = ""):
+    # Версию читаем до данных: при одновременном изменении ETag окажется старше, но не новее ответа
+    version = await crud.get_data_version(db, name)
+    etag = f'"{tenancy.current_tenant.get()}-{name}{variant}-{version}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(content=jsonable_encoder(await load()), headers=headers)
+
 @app.on_event("startup")
 async def startup():
     await database.init_db()
     async with database.AsyncSessionLocal() as db:
-        result = await db.execute(select(models.User).where(models.User.username == "admin"))
-        user = result.scalar_one_or_none()
-        if not user:
-            admin_user = models.User(
-                username="admin",
-                email="admin@salon.com",
-                hashed_password=get_password_hash("admin123"),
-                is_admin=True
-            )
-            db.add(admin_user)
-            await db.commit()
-
-        result = await db.execute(select(models.Service))
-        services = result.scalars().all()
-        if not services:
-            demo_services = [
-                models.Service(
-                    name="Стрижка женская",
-                    price=1500.0,
-                    duration=60,
-                    description="Стрижка и укладка"
-                ),
-                models.Service(
-                    name="Стрижка мужская", 
-                    price=800.0,
-                    duration=30,
-                    description="Стрижка машинкой или ножницами"
-                ),
-                models.Service(
-                    name="Окрашивание",
-                    price=2500.0,
-                    duration=120,
-                    description="Окрашивание волос"
-                ),
-                models.Service(
-                    name="Маникюр",
-                    price=1000.0,
-                    duration=60,
-                    description="Классический маникюр"
-                ),
-            ]
-            for service in demo_services:
-                db.add(service)
-            await db.commit()
+        await crud.prepare_db(db, tenancy.DEFAULT_TENANT)
+
+    if settings.archive_interval_hours > 0:
+        app.state.archive_task = asyncio.create_task(archive.run_periodically())
+    app.state.revocation_task = asyncio.create_task(revocation.run_periodically())
+
+@app.on_event("shutdown")
+async def shutdown():
+    jobs.shutdown()
+    await database.dispose_engines()
+
+# Профилирование одного запроса по заголовку X-Profile или параметру __profile, только для админа.
+# Объявлен раньше tenant_middleware, поэтому выполняется внутри него и уже знает салон
+@app.middleware("http")
+async def profiling_middleware(request: Request, call_next):
+    if not profiling.is_requested(request):
+        return await call_next(request)
+    
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    session_factory = await database.get_session_factory()
+    try:
+        async with session_factory() as db:
+            user = await get_current_active_user(await get_current_user(token=token, db=db))
+    except HTTPException as e:
+        return JSONResponse(status_code=e.status_code, content={"detail": e.detail}, headers=e.headers)
+    if scheme.lower() != "bearer" or not user.is_admin:
+        return JSONResponse(status_code=403, content={"detail": "Not enough permissions"})
+    
+    return await profiling.profile_request(
+        request, call_next, session_factory.kw["bind"], tenancy.current_tenant.get(), user.username
+    )
+
+@app.middleware("http")
+async def tenant_middleware(request: Request, call_next):
+    try:
+        tenant = tenancy.resolve_tenant(request.headers, request.headers.get("host"))
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"detail": str(e)})
+    except LookupError as e:
+        return JSONResponse(status_code=404, content={"detail": str(e)})
+    token = tenancy.current_tenant.set(tenant)
+    try:
+        return await call_next(request)
+    finally:
+        tenancy.current_tenant.reset(token)
 
 @app.post("/token")
 async def login_for_access_token(
@@ -90,7 +110,36 @@ async def login_for_access_token(
     access_token = create_access_token(
         data={"sub": user.username}, expires_delta=access_token_expires
     )
-    return {"access_token": access_token, "token_type": "bearer"}
+    refresh_token = await create_refresh_token(db, user)
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token}
+
+# Новая пара токенов по refresh-токену без повторной проверки пароля
+@app.post("/token/refresh")
+async def refresh_access_token(
+    refresh_token: str = Form(...),
+    db: AsyncSession = Depends(database.get_db)
+):
+    user, new_refresh_token = await rotate_refresh_token(db, refresh_token)
+    access_token_expires = timedelta(minutes=settings.access_token_expire_minutes)
+    access_token = create_access_token(
+        data={"sub": user.username}, expires_delta=access_token_expires
+    )
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": new_refresh_token}
+
+@app.post("/logout")
+async def logout(
+    refresh_token: Optional[str] = Form(None),
+    token: str = Depends(oauth2_scheme),
+    db: AsyncSession = Depends(database.get_db)
+):
+    try:
+        payload = jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm])
+        await revocation.revoke_access_token(db, payload.get("jti"), payload.get("exp"))
+    except JWTError:
+        pass
+    if refresh_token:
+        await revoke_refresh_token(db, refresh_token)
+    return {"message": "Logged out"}
 
 @app.post("/register")
 async def register_user(
@@ -122,10 +171,12 @@ async def register_user(
     access_token = create_access_token(
         data={"sub": new_user.username}, expires_delta=access_token_expires
     )
+    refresh_token = await create_refresh_token(db, new_user)
     
     return {
         "access_token": access_token, 
         "token_type": "bearer",
+        "refresh_token": refresh_token,
         "user_id": new_user.id,
         "username": new_user.username,
         "is_admin": new_user.is_admin
@@ -149,20 +200,48 @@ async def create_service(service: schemas.ServiceCreate, db: AsyncSession = Depe
     return await crud.create_service(db=db, service=service)
 
 @app.get("/services/", response_model=List[schemas.Service])
-async def read_services(skip: int = 0, limit: int = 100, db: AsyncSession = Depends(database.get_db)):
-    services = await crud.get_services(db, skip=skip, limit=limit)
-    return services
+async def read_services(request: Request, skip: int = 0, limit: int = 100, db: AsyncSession = Depends(database.get_db)):
+    async def load():
+        services = await crud.get_services(db, skip=skip, limit=limit)
+        return [schemas.Service.model_validate(service) for service in services]
+    return await versioned_response(request, db, "services", load, variant=f"-{skip}-{limit}")
 
 @app.post("/appointments/", response_model=schemas.AppointmentSimple)
-async def create_appointment(appointment: schemas.AppointmentCreate, db: AsyncSession = Depends(database.get_db)):
+async def create_appointment(
+    appointment: schemas.AppointmentCreate,
+    idempotency_key: Optional[str] = Header(None),
+    db: AsyncSession = Depends(database.get_db)
+):
     print(f"Received appointment data: {appointment.dict()}")
-    try:
-        result = await crud.create_appointment(db=db, appointment=appointment)
-        print(f"Appointment created successfully: {result.id}")
-        return result
-    except Exception as e:
-        print(f"Error creating appointment: {str(e)}")
-        raise HTTPException(status_code=400, detail=str(e))
+
+    def response_body(db_appointment):
+        return jsonable_encoder(schemas.AppointmentSimple.model_validate(db_appointment))
+
+    async def handler(record_response=None):
+        after_add = None
+        if record_response:
+            # Ответ для Idempotency-Key сохраняется в той же транзакции, что и запись
+            after_add = lambda session, db_appointment: record_response(session, response_body(db_appointment))
+        try:
+            result = await crud.create_appointment(db=db, appointment=appointment, after_add=after_add)
+            print(f"Appointment created successfully: {result.id}")
+            return response_body(result)
+        except Exception as e:
+            # Конфликт ключа с другим воркером разбирает idempotency.execute и отдаёт сохранённый ответ
+            if record_response and isinstance(e, IntegrityError):
+                raise
+            print(f"Error creating appointment: {str(e)}")
+            raise HTTPException(status_code=400, detail=str(e))
+
+    if not idempotency_key:
+        return await handler()
+
+    # Повторы с тем же Idempotency-Key получают исходный ответ без новой записи
+    status_code, body, replayed = await idempotency.execute(
+        db, idempotency_key, idempotency.fingerprint(appointment), handler
+    )
+    headers = {"Idempotent-Replayed": "true"} if replayed else None
+    return JSONResponse(status_code=status_code, content=body, headers=headers)
 
 @app.get("/appointments/", response_model=List[schemas.Appointment])
 async def read_appointments(skip: int = 0, limit: int = 100, db: AsyncSession = Depends(database.get_db)):
@@ -191,24 +270,8 @@ async def read_appointments_with_details(skip: int = 0, limit: int = 100, db: As
 
 # История записей для клиента по телефону
 @app.get("/client-appointments/{phone}")
-async def get_client_appointments(phone: str, db: AsyncSession = Depends(database.get_db)):
-    appointments = await crud.get_appointments_by_phone(db, phone)
-    return [
-        {
-            "id": appointment.Appointment.id,
-            "client_id": appointment.Appointment.client_id,
-            "service_id": appointment.Appointment.service_id,
-            "appointment_date": appointment.Appointment.appointment_date,
-            "status": appointment.Appointment.status,
-            "notes": appointment.Appointment.notes,
-            "created_at": appointment.Appointment.created_at,
-            "client_name": appointment.client_name,
-            "client_phone": appointment.client_phone,
-            "service_name": appointment.service_name,
-            "service_price": appointment.service_price
-        }
-        for appointment in appointments
-    ]
+async def get_client_appointments(phone: str, include_archived: bool = False, db: AsyncSession = Depends(database.get_db)):
+    return await crud.get_client_history(db, phone, include_archived=include_archived)
 
 # Все записи для админа с фильтрацией
 @app.get("/admin/all-appointments/")
@@ -236,6 +299,26 @@ async def get_all_appointments(
         for appointment in appointments
     ]
 
+# Календарь на неделю/месяц в компактном колоночном виде:
+# start - минуты от начала периода, status/client/service - индексы в statuses/clients/services
+@app.get("/admin/calendar")
+async def get_calendar(
+    date_from: str = Query(..., alias="from"),
+    date_to: str = Query(..., alias="to"),
+    current_user: models.User = Depends(get_current_admin_user),
+    db: AsyncSession = Depends(database.get_db)
+):
+    try:
+        date_from_obj = datetime.strptime(date_from, '%Y-%m-%d')
+        date_to_obj = datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dates must be in YYYY-MM-DD format")
+    if date_to_obj <= date_from_obj:
+        raise HTTPException(status_code=400, detail="'to' must not be earlier than 'from'")
+    if date_to_obj - date_from_obj > timedelta(days=CALENDAR_MAX_DAYS):
+        raise HTTPException(status_code=400, detail=f"Calendar range is limited to {CALENDAR_MAX_DAYS} days")
+    return await crud.get_calendar(db, date_from_obj, date_to_obj)
+
 @app.put("/appointments/{appointment_id}/status")
 async def update_appointment_status(appointment_id: int, status_data: dict, db: AsyncSession = Depends(database.get_db)):
     status = status_data.get('status')
@@ -261,6 +344,50 @@ async def update_appointment_status(appointment_id: int, status_data: dict, db:
     else:
         raise HTTPException(status_code=404, detail="Appointment not found")
 
+# Перенос старых завершённых/отменённых записей и их выручки в архивные таблицы
+@app.post("/admin/archive")
+async def archive_appointments(
+    older_than_days: Optional[int] = Query(None, ge=1),
+    current_user: models.User = Depends(get_current_admin_user),
+    db: AsyncSession = Depends(database.get_db)
+):
+    return await archive.archive_old_appointments(db, older_than_days=older_than_days)
+
+@app.get("/admin/cache-stats")
+async def get_cache_stats(current_user: models.User = Depends(get_current_admin_user)):
+    return {
+        "tenant": tenancy.current_tenant.get(),
+        "open_tenants": database.open_tenants(),
+        "client_history": crud.get_client_history_cache().stats()
+    }
+
+# Тяжёлые отчёты и выгрузки считаются в пуле процессов, а не в обработчике запроса
+@app.post("/admin/jobs")
+async def submit_job(job_data: schemas.JobCreate, current_user: models.User = Depends(get_current_admin_user)):
+    return jobs.job_status(jobs.submit(job_data.kind, job_data.params))
+
+@app.get("/admin/jobs/{job_id}")
+async def get_job_status(job_id: str, current_user: models.User = Depends(get_current_admin_user)):
+    return jobs.job_status(jobs.get_job(job_id))
+
+@app.get("/admin/jobs/{job_id}/download")
+async def download_job_result(job_id: str, current_user: models.User = Depends(get_current_admin_user)):
+    job = jobs.get_job(job_id)
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+    return FileResponse(job["path"], media_type="text/csv", filename=f"{job['kind']}-{job_id[:8]}.csv")
+
+@app.get("/admin/profiles")
+async def list_profile_reports(current_user: models.User = Depends(get_current_admin_user)):
+    return profiling.list_reports()
+
+@app.get("/admin/profiles/{name}")
+async def get_profile_report(name: str, current_user: models.User = Depends(get_current_admin_user)):
+    path = profiling.report_path(name)
+    if not path:
+        raise HTTPException(status_code=404, detail="Profile report not found")
+    return FileResponse(path, media_type="text/plain")
+
 @app.get("/statistics/")
 async def get_statistics(db: AsyncSession = Depends(database.get_db)):
     return await crud.get_statistics(db)
@@ -274,13 +401,24 @@ async def update_settings(settings_data: schemas.AdminSettingsBase, db: AsyncSes
     return await crud.update_admin_settings(db=db, settings_data=settings_data)
 
 @app.get("/settings/", response_model=schemas.AdminSettings)
-async def get_public_settings(db: AsyncSession = Depends(database.get_db)):
-    return await crud.get_admin_settings(db)
+async def get_public_settings(request: Request, db: AsyncSession = Depends(database.get_db)):
+    async def load():
+        return schemas.AdminSettings.model_validate(await crud.get_admin_settings(db))
+    return await versioned_response(request, db, "settings", load)
 
 @app.get("/", response_class=HTMLResponse)
 async def read_index(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
+# Service worker отдаётся из корня, чтобы его область действия покрывала весь сайт
+@app.get("/sw.js")
+async def service_worker():
+    return FileResponse(
+        "frontend/sw.js",
+        media_type="application/javascript",
+        headers={"Cache-Control": "no-cache", "Service-Worker-Allowed": "/"}
+    )
+
 @app.get("/admin", response_class=HTMLResponse)
 async def read_admin(request: Request):
     return templates.TemplateResponse("admin.html", {"request": request})
@@ -22,6 +22,7 @@ class Client(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, index=True)
     phone = Column(String, unique=True, index=True)
+    phone_key = Column(String, index=True, nullable=True)  # телефон без форматирования, см. crud.normalize_phone
     email = Column(String, nullable=True)
     notes = Column(Text, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -43,6 +44,8 @@ class Service(Base):
 
 class Appointment(Base):
     __tablename__ = "appointments"
+    # id переезжает в архив вместе со строкой, поэтому не должен выдаваться повторно
+    __table_args__ = {"sqlite_autoincrement": True}
     
     id = Column(Integer, primary_key=True, index=True)
     client_id = Column(Integer, ForeignKey("clients.id"))
@@ -51,6 +54,10 @@ class Appointment(Base):
     status = Column(String, default="pending")  # pending, confirmed, completed, cancelled, no-show
     notes = Column(Text, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Снимок услуги на момент записи: списки не джойнят services, а смена цены не меняет историю
+    service_name = Column(String, nullable=True)
+    service_price = Column(Float, nullable=True)
+    service_duration = Column(Integer, nullable=True)
     
     client = relationship("Client", back_populates="appointments")
     service = relationship("Service", back_populates="appointments")
@@ -68,6 +75,7 @@ class AdminSettings(Base):
 
 class Revenue(Base):
     __tablename__ = "revenues"
+    __table_args__ = {"sqlite_autoincrement": True}
     
     id = Column(Integer, primary_key=True, index=True)
     date = Column(DateTime, default=datetime.utcnow)
@@ -75,4 +83,66 @@ class Revenue(Base):
     appointment_id = Column(Integer, ForeignKey("appointments.id"))
     service_revenue = Column(Float)
     material_costs = Column(Float, default=0)
-    net_revenue = Column(Float)
\ No newline at end of file
+    net_revenue = Column(Float)
+
+# Версии справочников для ETag: растут при каждом изменении услуг или настроек
+class DataVersion(Base):
+    __tablename__ = "data_versions"
+    
+    name = Column(String, primary_key=True)
+    version = Column(Integer, default=0)
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String)
+    status_code = Column(Integer, nullable=True)
+    response_body = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+# Архив старых записей: те же колонки, но без связей, чтобы горячие таблицы оставались маленькими
+class ArchivedAppointment(Base):
+    __tablename__ = "archived_appointments"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    client_id = Column(Integer, ForeignKey("clients.id"), index=True)
+    service_id = Column(Integer, ForeignKey("services.id"))
+    appointment_date = Column(DateTime)
+    status = Column(String)
+    notes = Column(Text, nullable=True)
+    created_at = Column(DateTime)
+    service_name = Column(String, nullable=True)
+    service_price = Column(Float, nullable=True)
+    service_duration = Column(Integer, nullable=True)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+class ArchivedRevenue(Base):
+    __tablename__ = "archived_revenues"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    date = Column(DateTime)
+    service_id = Column(Integer, ForeignKey("services.id"))
+    appointment_id = Column(Integer, ForeignKey("archived_appointments.id"), index=True)
+    service_revenue = Column(Float)
+    material_costs = Column(Float, default=0)
+    net_revenue = Column(Float)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+class RefreshToken(Base):
+    __tablename__ = "refresh_tokens"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    token_hash = Column(String, unique=True, index=True)  # sha256 от токена, сам токен не храним
+    family_id = Column(String, index=True)  # все токены одной цепочки ротации
+    expires_at = Column(DateTime)
+    revoked_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class RevokedToken(Base):
+    __tablename__ = "revoked_tokens"
+    
+    jti = Column(String, primary_key=True)
+    expires_at = Column(DateTime, index=True)
+    revoked_at = Column(DateTime, default=datetime.utcnow, index=True)
\ No newline at end of file
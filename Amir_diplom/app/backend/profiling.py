@@ -0,0 +1,116 @@
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import re
+import time
+from contextvars import ContextVar
+from datetime import datetime
+
+from sqlalchemy import event
+
+from .config import settings
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_QUERY_PARAM = "__profile"
+REPORT_NAME_RE = re.compile(r'^[\w.-]+\.txt$')
+
+# Список SQL-запросов профилируемого запроса; None - трассировка выключена
+_sql_trace: ContextVar = ContextVar("sql_trace", default=None)
+# cProfile профилирует весь поток, поэтому одновременно профилируем только один запрос
+_lock = asyncio.Lock()
+
+
+def is_requested(request) -> bool:
+    return bool(request.headers.get(PROFILE_HEADER) or request.query_params.get(PROFILE_QUERY_PARAM))
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _sql_trace.get() is not None:
+        conn.info.setdefault("profile_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    trace = _sql_trace.get()
+    if trace is not None and conn.info.get("profile_query_start"):
+        started = conn.info["profile_query_start"].pop()
+        trace.append((time.perf_counter() - started, statement))
+
+
+def _listen(engine):
+    event.listen(engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _unlisten(engine):
+    event.remove(engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.remove(engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _prune_reports():
+    reports = sorted(
+        (os.path.join(settings.profile_dir, name) for name in os.listdir(settings.profile_dir)),
+        key=os.path.getmtime
+    )
+    for path in reports[:max(len(reports) - settings.profile_max_reports, 0)]:
+        os.remove(path)
+
+
+def _write_report(request, tenant, username, status_code, elapsed, trace, profiler):
+    os.makedirs(settings.profile_dir, exist_ok=True)
+    slug = re.sub(r'[^\w-]+', '_', request.url.path).strip('_') or 'root'
+    name = f"{datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f')}-{slug}.txt"
+
+    report = io.StringIO()
+    report.write(f"{request.method} {request.url.path}?{request.url.query}\n")
+    report.write(f"tenant: {tenant}, user: {username}, status: {status_code}, total: {elapsed * 1000:.1f} ms\n")
+    report.write("cProfile covers the whole event loop thread, so concurrent requests may appear below.\n\n")
+
+    sql_total = sum(duration for duration, _ in trace)
+    report.write(f"SQL: {len(trace)} queries, {sql_total * 1000:.1f} ms\n")
+    for duration, statement in trace:
+        report.write(f"{duration * 1000:9.2f} ms  {' '.join(statement.split())}\n")
+
+    report.write("\n")
+    stats = pstats.Stats(profiler, stream=report)
+    stats.sort_stats("cumulative").print_stats(settings.profile_top_functions)
+
+    with open(os.path.join(settings.profile_dir, name), "w", encoding="utf-8") as f:
+        f.write(report.getvalue())
+    _prune_reports()
+    return name
+
+
+async def profile_request(request, call_next, engine, tenant: str, username: str):
+    async with _lock:
+        trace = []
+        token = _sql_trace.set(trace)
+        # Слушатели SQL висят на движке только на время профилирования
+        _listen(engine)
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            response = await call_next(request)
+        finally:
+            profiler.disable()
+            _unlisten(engine)
+            _sql_trace.reset(token)
+        elapsed = time.perf_counter() - started
+
+        name = _write_report(request, tenant, username, response.status_code, elapsed, trace, profiler)
+        response.headers["X-Profile-Report"] = name
+        return response
+
+
+def list_reports():
+    if not os.path.isdir(settings.profile_dir):
+        return []
+    return sorted(name for name in os.listdir(settings.profile_dir) if REPORT_NAME_RE.match(name))
+
+
+def report_path(name: str):
+    if name not in list_reports():
+        return None
+    return os.path.join(settings.profile_dir, name)
@@ -0,0 +1,114 @@
+import asyncio
+import calendar
+import hashlib
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from . import models, database
+from .config import settings
+
+
+class BloomFilter:
+    def __init__(self, size_bits: int, hash_count: int):
+        self.size_bits = size_bits
+        self.hash_count = hash_count
+        self._bits = bytearray((size_bits + 7) // 8)
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=8 * self.hash_count).digest()
+        for i in range(self.hash_count):
+            yield int.from_bytes(digest[i * 8:(i + 1) * 8], "little") % self.size_bits
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self._bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, item: str):
+        return all(self._bits[position // 8] & (1 << (position % 8)) for position in self._positions(item))
+
+
+class RevocationList:
+    """Отозванные access-токены (jti) без обращения к БД на каждый запрос.
+
+    Блум-фильтр быстро отвечает "точно не отозван" для почти всех токенов,
+    точное множество с временем истечения убирает ложные срабатывания.
+    """
+
+    def __init__(self, size_bits: int = 1 << 20, hash_count: int = 4):
+        self.size_bits = size_bits
+        self.hash_count = hash_count
+        self._bloom = BloomFilter(size_bits, hash_count)
+        self._exact = {}
+
+    def add(self, jti: str, expires_at: float):
+        self._bloom.add(jti)
+        self._exact[jti] = expires_at
+
+    def is_revoked(self, jti: str) -> bool:
+        if jti is None or jti not in self._bloom:
+            return False
+        expires_at = self._exact.get(jti)
+        return expires_at is not None and expires_at > time.time()
+
+    def prune(self):
+        # Истёкшие токены и так не пройдут проверку exp, поэтому их можно забыть и перестроить фильтр
+        now = time.time()
+        self._exact = {jti: expires_at for jti, expires_at in self._exact.items() if expires_at > now}
+        self._bloom = BloomFilter(self.size_bits, self.hash_count)
+        for jti in self._exact:
+            self._bloom.add(jti)
+
+
+revocation_list = RevocationList()
+
+# Запас на записи других воркеров, закоммиченные уже после предыдущей синхронизации
+SYNC_OVERLAP = timedelta(minutes=1)
+
+
+async def revoke_access_token(db: AsyncSession, jti: str, exp: int):
+    if not jti or revocation_list.is_revoked(jti):
+        return
+    db.add(models.RevokedToken(jti=jti, expires_at=datetime.utcfromtimestamp(exp)))
+    await db.commit()
+    revocation_list.add(jti, exp)
+
+
+async def sync(db: AsyncSession, tenant: str):
+    # Подтягиваем отзывы, сделанные другими воркерами
+    # Время последней синхронизации хранится в состоянии салона: у каждого своя таблица revoked_tokens
+    state = database.get_tenant_state(tenant)
+    query = select(models.RevokedToken).where(models.RevokedToken.expires_at > datetime.utcnow())
+    if "revocations_synced_at" in state:
+        query = query.where(models.RevokedToken.revoked_at >= state["revocations_synced_at"] - SYNC_OVERLAP)
+    synced_at = datetime.utcnow()
+    result = await db.execute(query)
+    for token in result.scalars().all():
+        revocation_list.add(token.jti, calendar.timegm(token.expires_at.utctimetuple()))
+    state["revocations_synced_at"] = synced_at
+
+
+# Истёкшие токены больше ни на что не влияют; отозванные, но не истёкшие refresh-токены
+# остаются, чтобы их повторное использование по-прежнему отзывало цепочку
+async def purge_expired(db: AsyncSession):
+    now = datetime.utcnow()
+    await db.execute(delete(models.RefreshToken).where(models.RefreshToken.expires_at < now))
+    await db.execute(delete(models.RevokedToken).where(models.RevokedToken.expires_at < now))
+    await db.commit()
+
+
+async def run_periodically():
+    while True:
+        await asyncio.sleep(settings.revocation_sync_seconds)
+        revocation_list.prune()
+        for tenant in database.open_tenants():
+            try:
+                session_factory = await database.get_session_factory(tenant)
+                async with session_factory() as db:
+                    await sync(db, tenant)
+                    await purge_expired(db)
+            except Exception as e:
+                print(f"Error syncing revoked tokens for {tenant}: {str(e)}")
@@ -127,4 +127,8 @@ class AdminSettings(AdminSettingsBase):
     id: int
     
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+class JobCreate(BaseModel):
+    kind: str
+    params: dict = {}
\ No newline at end of file
@@ -0,0 +1,43 @@
+import re
+from contextvars import ContextVar
+
+from .config import settings
+
+DEFAULT_TENANT = "default"
+TENANT_NAME_RE = re.compile(r'^[a-z0-9][a-z0-9_-]{0,62}$')
+
+# Салон текущего запроса; выставляется middleware в main.py
+current_tenant: ContextVar[str] = ContextVar("current_tenant", default=DEFAULT_TENANT)
+
+
+def known_tenants():
+    return {DEFAULT_TENANT, *(name.strip().lower() for name in settings.tenants.split(',') if name.strip())}
+
+
+def resolve_tenant(headers, host: str) -> str:
+    if not settings.multi_tenant:
+        return DEFAULT_TENANT
+
+    tenant = headers.get(settings.tenant_header)
+    if not tenant and settings.tenant_base_domain and host:
+        hostname = host.split(':')[0].lower()
+        suffix = '.' + settings.tenant_base_domain.lower()
+        if hostname.endswith(suffix):
+            tenant = hostname[:-len(suffix)]
+    if not tenant:
+        return DEFAULT_TENANT
+
+    tenant = tenant.lower()
+    # Имя салона попадает в путь к файлу БД, поэтому допускаем только безопасные символы
+    if not TENANT_NAME_RE.match(tenant):
+        raise ValueError(f"Invalid tenant name: {tenant}")
+    # Салоны заводятся только в настройках, чтобы запрос не мог создать новую БД
+    if tenant not in known_tenants():
+        raise LookupError(f"Unknown tenant: {tenant}")
+    return tenant
+
+
+def tenant_database_url(tenant: str) -> str:
+    if tenant == DEFAULT_TENANT:
+        return settings.database_url
+    return settings.tenant_database_url_template.format(tenant=tenant)
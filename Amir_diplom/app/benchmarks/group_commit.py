@@ -0,0 +1,100 @@
+# Сравнение обычного создания записей и group commit на всплеске бронирований,
+# без Idempotency-Key и с ним (как у записей со страницы через service worker).
+# Запуск из каталога app: python -m benchmarks.group_commit --bookings 500 --concurrency 100
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+DB_DIR = tempfile.mkdtemp(prefix="salon-bench-")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{DB_DIR}/bench.db"
+
+from backend import crud, database, idempotency, models, schemas  # noqa: E402
+from backend.config import settings  # noqa: E402
+
+
+async def create(db, index: int, appointment: schemas.AppointmentCreate, with_key: bool):
+    if not with_key:
+        await crud.create_appointment(db, appointment)
+        return
+
+    # Тот же путь, что у POST /appointments/ с Idempotency-Key: ответ сохраняется в транзакции записи
+    async def handler(record):
+        db_appointment = await crud.create_appointment(
+            db, appointment, after_add=lambda session, row: record(session, {"id": row.id})
+        )
+        return {"id": db_appointment.id}
+
+    await idempotency.execute(db, f"bench-{index}", idempotency.fingerprint(appointment), handler)
+
+
+async def book(index: int, latencies: list, semaphore: asyncio.Semaphore, with_key: bool):
+    appointment = schemas.AppointmentCreate(
+        client_name=f"Клиент {index}",
+        client_phone=f"+7900{index:07d}",
+        service_id=1,
+        appointment_date=datetime(2030, 1, 1, 9) + timedelta(minutes=30 * index)
+    )
+    async with semaphore:
+        started = time.perf_counter()
+        async with database.AsyncSessionLocal() as db:
+            await create(db, index, appointment, with_key)
+        latencies.append(time.perf_counter() - started)
+
+
+async def run(mode: str, bookings: int, concurrency: int, offset: int):
+    settings.booking_batch_enabled = mode.startswith("batched")
+    with_key = mode.endswith("+key")
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    started = time.perf_counter()
+    await asyncio.gather(*[book(offset + i, latencies, semaphore, with_key) for i in range(bookings)])
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "mode": mode,
+        "throughput": bookings / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        "max_ms": latencies[-1] * 1000,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bookings", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=settings.booking_batch_max_size)
+    parser.add_argument("--batch-wait-ms", type=int, default=settings.booking_batch_max_wait_ms)
+    args = parser.parse_args()
+
+    settings.booking_batch_max_size = args.batch_size
+    settings.booking_batch_max_wait_ms = args.batch_wait_ms
+    database.engine.echo = False
+    await database.init_db()
+    async with database.AsyncSessionLocal() as db:
+        db.add(models.Service(name="Стрижка", price=1000.0, duration=30))
+        await db.commit()
+
+    results = []
+    for offset, mode in enumerate(["direct", "batched", "direct+key", "batched+key"]):
+        results.append(await run(mode, args.bookings, args.concurrency, offset * args.bookings))
+
+    print(f"{args.bookings} bookings, concurrency {args.concurrency}, "
+          f"batch {args.batch_size} / {args.batch_wait_ms} ms")
+    print(f"{'mode':<14}{'bookings/s':>12}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for result in results:
+        print(f"{result['mode']:<14}{result['throughput']:>12.1f}{result['p50_ms']:>10.1f}"
+              f"{result['p95_ms']:>10.1f}{result['max_ms']:>10.1f}")
+    direct, batched, direct_key, batched_key = results
+    print(f"group commit: throughput x{batched['throughput'] / direct['throughput']:.2f}, "
+          f"p50 latency {batched['p50_ms'] - direct['p50_ms']:+.1f} ms")
+    print(f"group commit with Idempotency-Key: throughput x{batched_key['throughput'] / direct_key['throughput']:.2f}, "
+          f"key overhead x{batched_key['throughput'] / batched['throughput']:.2f} of batched")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
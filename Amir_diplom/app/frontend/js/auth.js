@@ -1,6 +1,8 @@
 class Auth {
     constructor() {
         this.token = localStorage.getItem('authToken');
+        this.refreshToken = localStorage.getItem('refreshToken');
+        this.refreshPromise = null;
         this.user = JSON.parse(localStorage.getItem('user') || 'null');
         this.init();
     }
@@ -18,6 +20,12 @@ class Auth {
                 this.login();
             });
         }
+
+        // Токены, обновлённые в другой вкладке
+        window.addEventListener('storage', (e) => {
+            if (e.key === 'authToken') this.token = e.newValue;
+            if (e.key === 'refreshToken') this.refreshToken = e.newValue;
+        });
     }
 
     async login() {
@@ -41,8 +49,7 @@ class Auth {
 
         if (response.ok) {
             const data = await response.json();
-            this.token = data.access_token;
-            localStorage.setItem('authToken', this.token);
+            this.setTokens(data);
             
             // Get user info
             try {
@@ -92,10 +99,73 @@ class Auth {
     }
 }
 
+    setTokens(data) {
+        this.token = data.access_token;
+        localStorage.setItem('authToken', this.token);
+        if (data.refresh_token) {
+            this.refreshToken = data.refresh_token;
+            localStorage.setItem('refreshToken', this.refreshToken);
+        }
+    }
+
+    // Обновляет access-токен по refresh-токену, без повторного ввода пароля
+    async refreshAccessToken(staleToken = this.token) {
+        // Одновременные запросы с истёкшим токеном ждут одно обновление
+        if (!this.refreshPromise) {
+            const refresh = () => this.refreshTokens(staleToken);
+            // Между вкладками обновление идёт под общей блокировкой: использованный refresh-токен
+            // повторно не отправляется, иначе сервер сочтёт это кражей и отзовёт всю цепочку
+            this.refreshPromise = (navigator.locks ? navigator.locks.request('auth-token-refresh', refresh) : refresh())
+                .catch(() => false)
+                .finally(() => {
+                    this.refreshPromise = null;
+                });
+        }
+        return this.refreshPromise;
+    }
+
+    async refreshTokens(staleToken) {
+        // Другая вкладка могла уже обновить токены, поэтому читаем их из localStorage, а не из памяти
+        const storedToken = localStorage.getItem('authToken');
+        if (storedToken && storedToken !== staleToken) {
+            this.token = storedToken;
+            this.refreshToken = localStorage.getItem('refreshToken');
+            return true;
+        }
+
+        const refreshToken = localStorage.getItem('refreshToken');
+        if (!refreshToken) return false;
+        const formData = new FormData();
+        formData.append('refresh_token', refreshToken);
+        const response = await fetch('/token/refresh', {
+            method: 'POST',
+            body: formData
+        });
+        if (!response.ok) return false;
+        this.setTokens(await response.json());
+        return true;
+    }
+
     logout() {
+        if (this.token) {
+            const formData = new FormData();
+            const refreshToken = localStorage.getItem('refreshToken');
+            if (refreshToken) {
+                formData.append('refresh_token', refreshToken);
+            }
+            // Отзываем токены на сервере, не дожидаясь ответа
+            fetch('/logout', {
+                method: 'POST',
+                headers: { 'Authorization': `Bearer ${this.token}` },
+                body: formData,
+                keepalive: true
+            }).catch(() => {});
+        }
         localStorage.removeItem('authToken');
+        localStorage.removeItem('refreshToken');
         localStorage.removeItem('user');
         this.token = null;
+        this.refreshToken = null;
         this.user = null;
         window.location.href = '/login';
     }
@@ -118,16 +188,25 @@ class Auth {
             throw new Error('Not authenticated');
         }
 
-        const defaultOptions = {
-            headers: {
-                'Authorization': `Bearer ${this.token}`,
-                'Content-Type': 'application/json',
-                ...options.headers
-            }
+        let usedToken = this.token;
+        const request = () => {
+            usedToken = this.token;
+            return fetch(url, {
+                ...options,
+                headers: {
+                    'Authorization': `Bearer ${usedToken}`,
+                    'Content-Type': 'application/json',
+                    ...options.headers
+                }
+            });
         };
 
-        const response = await fetch(url, { ...defaultOptions, ...options });
+        let response = await request();
         
+        if (response.status === 401 && await this.refreshAccessToken(usedToken)) {
+            response = await request();
+        }
+
         if (response.status === 401) {
             this.logout();
             throw new Error('Authentication failed');
@@ -10,10 +10,47 @@ class ClientApp {
         if (!window.auth.checkAuth()) return;
         
         this.bindEvents();
+        this.registerServiceWorker();
         this.loadServices();
         this.loadSettings();
         this.setupHeader();
     }
+
+    registerServiceWorker() {
+        if (!('serviceWorker' in navigator)) return;
+
+        navigator.serviceWorker.register('/sw.js').catch(error => {
+            console.error('Service worker registration failed:', error);
+        });
+
+        navigator.serviceWorker.addEventListener('message', (event) => {
+            const message = event.data || {};
+            if (message.type === 'data-updated') {
+                // Service worker получил свежие данные после показа закэшированных
+                if (message.url === '/services/') this.loadServices();
+                if (message.url === '/settings/') this.loadSettings();
+            } else if (message.type === 'booking-replayed') {
+                if (message.ok) {
+                    this.showNotification('Сохранённая запись отправлена! Мы свяжемся с вами для подтверждения.', 'success');
+                } else {
+                    this.showNotification('Не удалось отправить сохранённую запись', 'error');
+                }
+            }
+        });
+
+        window.addEventListener('online', () => {
+            if (navigator.serviceWorker.controller) {
+                navigator.serviceWorker.controller.postMessage({ type: 'replay-bookings' });
+            }
+        });
+    }
+
+    generateIdempotencyKey() {
+        if (window.crypto && crypto.randomUUID) {
+            return crypto.randomUUID();
+        }
+        return `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+    }
     
     setupHeader() {
         const user = window.auth.user;
@@ -159,6 +196,8 @@ class ClientApp {
         const serviceSelect = document.getElementById('service-select');
         if (!serviceSelect) return;
         
+        // Список может перерисоваться после фонового обновления - сохраняем выбор пользователя
+        const selectedServiceId = serviceSelect.value;
         serviceSelect.innerHTML = '<option value="">Выберите услугу</option>';
         
         if (this.services.length === 0) {
@@ -176,6 +215,7 @@ class ClientApp {
             option.textContent = `${service.name} - ${service.price} руб. (${service.duration} мин.)`;
             serviceSelect.appendChild(option);
         });
+        serviceSelect.value = selectedServiceId;
     }
 
     renderDirections() {
@@ -258,13 +298,19 @@ class ClientApp {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
+                    // Один ключ на отправку формы: повтор из офлайн-очереди не создаст дубликат
+                    'Idempotency-Key': this.generateIdempotencyKey()
                 },
                 body: JSON.stringify(formData)
             });
 
             console.log('Response status:', response.status);
 
-            if (response.ok) {
+            if (response.status === 202) {
+                this.showNotification('Нет подключения к сети. Запись сохранена и будет отправлена автоматически.', 'info');
+                document.getElementById('appointment-form').reset();
+                this.setDefaultDateTime();
+            } else if (response.ok) {
                 const result = await response.json();
                 console.log('Success:', result);
                 this.showNotification('Запись успешно создана! Мы свяжемся с вами для подтверждения.', 'success');
@@ -0,0 +1,210 @@
+// Service worker публичной страницы записи:
+// - статическая оболочка берётся из кэша и обновляется в фоне;
+// - /services/ и /settings/ отдаются из кэша (stale-while-revalidate) с перепроверкой по ETag;
+// - записи, сделанные без сети, складываются в IndexedDB и отправляются повторно.
+
+const SHELL_CACHE = 'salon-shell-v1';
+const DATA_CACHE = 'salon-data-v1';
+const SHELL_URLS = ['/', '/static/css/style.css', '/static/js/auth.js', '/static/js/main.js'];
+const DATA_URLS = ['/services/', '/settings/'];
+
+const QUEUE_DB = 'salon-offline';
+const QUEUE_STORE = 'bookings';
+const SYNC_TAG = 'replay-bookings';
+
+self.addEventListener('install', (event) => {
+    event.waitUntil(
+        caches.open(SHELL_CACHE)
+            .then(cache => cache.addAll(SHELL_URLS))
+            .then(() => self.skipWaiting())
+    );
+});
+
+self.addEventListener('activate', (event) => {
+    event.waitUntil(
+        caches.keys()
+            .then(keys => Promise.all(
+                keys
+                    .filter(key => key !== SHELL_CACHE && key !== DATA_CACHE)
+                    .map(key => caches.delete(key))
+            ))
+            .then(() => self.clients.claim())
+            .then(() => replayBookings())
+    );
+});
+
+self.addEventListener('fetch', (event) => {
+    const request = event.request;
+    const url = new URL(request.url);
+    if (url.origin !== self.location.origin) return;
+
+    if (request.method === 'POST' && url.pathname === '/appointments/') {
+        event.respondWith(submitBooking(request));
+        return;
+    }
+    if (request.method !== 'GET') return;
+
+    if (SHELL_URLS.includes(url.pathname)) {
+        event.respondWith(staleWhileRevalidate(event, SHELL_CACHE, request));
+    } else if (DATA_URLS.includes(url.pathname) && isPublicPageRequest(request)) {
+        event.respondWith(staleWhileRevalidate(event, DATA_CACHE, request, true));
+    }
+});
+
+// Кэш справочников нужен только публичной странице записи: админка сразу после изменения
+// перечитывает услуги и настройки и должна получить их из сети
+function isPublicPageRequest(request) {
+    if (request.headers.has('Authorization')) return false;
+    return !request.referrer || new URL(request.referrer).pathname === '/';
+}
+
+self.addEventListener('sync', (event) => {
+    if (event.tag === SYNC_TAG) {
+        event.waitUntil(replayBookings());
+    }
+});
+
+// Для браузеров без Background Sync страница просит повторить отправку при появлении сети
+self.addEventListener('message', (event) => {
+    if (event.data && event.data.type === 'replay-bookings') {
+        event.waitUntil(replayBookings());
+    }
+});
+
+async function staleWhileRevalidate(event, cacheName, request, notify = false) {
+    const cache = await caches.open(cacheName);
+    const cached = await cache.match(request);
+
+    const revalidate = revalidateEntry(cache, request, cached, notify);
+    if (cached) {
+        event.waitUntil(revalidate.catch(() => {}));
+        return cached;
+    }
+    return revalidate;
+}
+
+async function revalidateEntry(cache, request, cached, notify) {
+    const headers = {};
+    const etag = cached && cached.headers.get('ETag');
+    if (etag) {
+        headers['If-None-Match'] = etag;
+    }
+
+    const response = await fetch(request.url, { headers, cache: 'no-store', credentials: 'same-origin' });
+    if (response.status === 304 && cached) {
+        return cached;
+    }
+    if (response.ok) {
+        await cache.put(request, response.clone());
+        // Страница уже показала старые данные - сообщаем, что пришли новые
+        if (notify && cached) {
+            await broadcast({ type: 'data-updated', url: new URL(request.url).pathname });
+        }
+    }
+    return response;
+}
+
+async function submitBooking(request) {
+    const body = await request.clone().text();
+    try {
+        return await fetch(request);
+    } catch (error) {
+        await enqueueBooking({
+            body,
+            contentType: request.headers.get('Content-Type') || 'application/json',
+            idempotencyKey: request.headers.get('Idempotency-Key'),
+            queuedAt: Date.now()
+        });
+        if (self.registration.sync) {
+            try {
+                await self.registration.sync.register(SYNC_TAG);
+            } catch (syncError) {
+                // Background Sync недоступен - повторим по сообщению страницы
+            }
+        }
+        return new Response(JSON.stringify({ queued: true }), {
+            status: 202,
+            headers: { 'Content-Type': 'application/json' }
+        });
+    }
+}
+
+// activate, sync и сообщение со страницы могут прийти одновременно - очередь отправляет один проход
+let replayInProgress = null;
+
+function replayBookings() {
+    if (!replayInProgress) {
+        replayInProgress = replayQueue().finally(() => {
+            replayInProgress = null;
+        });
+    }
+    return replayInProgress;
+}
+
+async function replayQueue() {
+    const entries = await readQueue();
+    for (const entry of entries) {
+        const headers = { 'Content-Type': entry.contentType };
+        if (entry.idempotencyKey) {
+            // Тот же ключ, что и у исходной попытки: повтор не создаст дубликат
+            headers['Idempotency-Key'] = entry.idempotencyKey;
+        }
+
+        let response;
+        try {
+            response = await fetch('/appointments/', { method: 'POST', headers, body: entry.body });
+        } catch (error) {
+            return;
+        }
+
+        if (response.status >= 500) {
+            return;
+        }
+        await deleteFromQueue(entry.id);
+        await broadcast({ type: 'booking-replayed', ok: response.ok, status: response.status });
+    }
+}
+
+async function broadcast(message) {
+    const clients = await self.clients.matchAll({ type: 'window' });
+    clients.forEach(client => client.postMessage(message));
+}
+
+function openQueue() {
+    return new Promise((resolve, reject) => {
+        const request = indexedDB.open(QUEUE_DB, 1);
+        request.onupgradeneeded = () => {
+            request.result.createObjectStore(QUEUE_STORE, { keyPath: 'id', autoIncrement: true });
+        };
+        request.onsuccess = () => resolve(request.result);
+        request.onerror = () => reject(request.error);
+    });
+}
+
+async function queueTransaction(mode, action) {
+    const db = await openQueue();
+    return new Promise((resolve, reject) => {
+        const transaction = db.transaction(QUEUE_STORE, mode);
+        const request = action(transaction.objectStore(QUEUE_STORE));
+        transaction.oncomplete = () => {
+            db.close();
+            resolve(request.result);
+        };
+        transaction.onerror = () => {
+            db.close();
+            reject(transaction.error);
+        };
+    });
+}
+
+function enqueueBooking(entry) {
+    return queueTransaction('readwrite', store => store.add(entry));
+}
+
+function readQueue() {
+    return queueTransaction('readonly', store => store.getAll());
+}
+
+function deleteFromQueue(id) {
+    return queueTransaction('readwrite', store => store.delete(id));
+}
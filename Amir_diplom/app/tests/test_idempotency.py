@@ -0,0 +1,40 @@
+import asyncio
+
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from backend import database, idempotency
+
+
+def test_duplicate_survives_cancellation_of_first_request(tmp_path):
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/test.db")
+        await database.init_db(engine)
+        session_factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+        calls = []
+
+        async def handler(record):
+            calls.append(1)
+            if len(calls) == 1:
+                await asyncio.sleep(10)
+            return {"id": len(calls)}
+
+        async def request():
+            async with session_factory() as db:
+                return await idempotency.execute(db, "flaky", "fingerprint", handler)
+
+        try:
+            first = asyncio.create_task(request())
+            await asyncio.sleep(0.05)
+            duplicate = asyncio.create_task(request())
+            await asyncio.sleep(0.05)
+            first.cancel()
+
+            # Повтор не должен получить чужой CancelledError: он выполняет запрос сам
+            status_code, body, replayed = await duplicate
+            assert (status_code, body, replayed) == (200, {"id": 2}, False)
+            assert first.cancelled()
+        finally:
+            await engine.dispose()
+
+    asyncio.run(scenario())
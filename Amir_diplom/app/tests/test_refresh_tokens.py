@@ -0,0 +1,101 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from fastapi import HTTPException
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from backend import auth, database, models, revocation
+
+
+async def _make_session_factory(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/test.db")
+    await database.init_db(engine)
+    return engine, sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+
+async def _create_user_token(session_factory):
+    async with session_factory() as db:
+        user = models.User(username="admin", email="admin@salon.com", hashed_password="-", is_admin=True)
+        db.add(user)
+        await db.commit()
+        return await auth.create_refresh_token(db, user)
+
+
+async def _rotate(session_factory, token):
+    async with session_factory() as db:
+        return await auth.rotate_refresh_token(db, token)
+
+
+def test_concurrent_refresh_rotates_token_once(tmp_path):
+    async def scenario():
+        engine, session_factory = await _make_session_factory(tmp_path)
+        try:
+            token = await _create_user_token(session_factory)
+            results = await asyncio.gather(
+                *[_rotate(session_factory, token) for _ in range(3)], return_exceptions=True
+            )
+            rotated = [result for result in results if not isinstance(result, BaseException)]
+            rejected = [result for result in results if isinstance(result, HTTPException)]
+            assert len(rotated) == 1
+            assert len(rejected) == 2
+            assert all(error.status_code == 401 for error in rejected)
+
+            # Проигравшие запросы - повторное использование токена, поэтому отозвана вся цепочка
+            _, new_token = rotated[0]
+            try:
+                await _rotate(session_factory, new_token)
+            except HTTPException as error:
+                assert error.status_code == 401
+            else:
+                raise AssertionError("refresh token of a revoked family was accepted")
+        finally:
+            await engine.dispose()
+
+    asyncio.run(scenario())
+
+
+def test_refresh_token_rotates_and_old_token_is_rejected(tmp_path):
+    async def scenario():
+        engine, session_factory = await _make_session_factory(tmp_path)
+        try:
+            token = await _create_user_token(session_factory)
+            user, new_token = await _rotate(session_factory, token)
+            assert user.username == "admin"
+            assert new_token != token
+
+            user, newer_token = await _rotate(session_factory, new_token)
+            assert newer_token not in (token, new_token)
+        finally:
+            await engine.dispose()
+
+    asyncio.run(scenario())
+
+
+def test_purge_removes_only_expired_tokens(tmp_path):
+    async def scenario():
+        engine, session_factory = await _make_session_factory(tmp_path)
+        try:
+            token = await _create_user_token(session_factory)
+            _, new_token = await _rotate(session_factory, token)
+            async with session_factory() as db:
+                db.add(models.RefreshToken(
+                    user_id=1, token_hash="expired", family_id="old", expires_at=datetime.utcnow() - timedelta(days=1)
+                ))
+                db.add(models.RevokedToken(jti="expired", expires_at=datetime.utcnow() - timedelta(minutes=1)))
+                db.add(models.RevokedToken(jti="active", expires_at=datetime.utcnow() + timedelta(minutes=1)))
+                await db.commit()
+
+                await revocation.purge_expired(db)
+
+                token_hashes = (await db.execute(select(models.RefreshToken.token_hash))).scalars().all()
+                assert "expired" not in token_hashes
+                # Заменённый при ротации токен ещё нужен для обнаружения повторного использования
+                assert len(token_hashes) == 2
+                jtis = (await db.execute(select(models.RevokedToken.jti))).scalars().all()
+                assert jtis == ["active"]
+        finally:
+            await engine.dispose()
+
+    asyncio.run(scenario())